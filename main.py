@@ -1,18 +1,55 @@
 import os
+import asyncio
 import logging
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 import run
 
 logging.basicConfig(level=logging.INFO)
 
 
-def main(python_driver_git, scylla_install_dir, driver_type, tests, versions, protocols, scylla_version):
-    results = []
-    for version in versions:
-        for protocol in protocols:
-            logging.info('=== PYTHON DRIVER VERSION {}, PROTOCOL v{} ==='.format(version, protocol))
-            results.append(run.Run(python_driver_git, driver_type, scylla_install_dir, version, protocol, tests, scylla_version=scylla_version))
+def _as_list(value, default=None):
+    # comma separated command line value, empty items dropped
+    if isinstance(value, list):
+        return value
+    return [item for item in value.split(',') if item] or default or []
+
+
+async def _run_matrix(python_driver_git, scylla_install_dir, driver_type, tests, versions, protocols, scylla_version,
+                      nose_processes, use_cache, cache_dir):
+    loop = asyncio.get_running_loop()
+    # checkouts, patching and pip installs of the versions overlap, while Run.execute() lets a single nosetests run
+    # at a time, as the ccm clusters of all runs share the same addresses
+    setup_slots = asyncio.Semaphore(os.cpu_count())
+    checkouts = {}
+
+    with ThreadPoolExecutor(max_workers=max(1, len(versions) * len(protocols))) as executor:
+        async def run_protocol(version, protocol):
+            result = run.Run(python_driver_git, driver_type, scylla_install_dir, version, protocol, tests,
+                             scylla_version=scylla_version, nose_processes=nose_processes, use_cache=use_cache,
+                             cache_dir=cache_dir)
+            if await loop.run_in_executor(executor, result.load_cached_result):
+                return result
+            if version not in checkouts:
+                checkouts[version] = asyncio.ensure_future(run.checkout(python_driver_git, driver_type, version))
+            checked_out = await checkouts[version]
+            async with setup_slots:
+                ready = await loop.run_in_executor(executor, result.setup, checked_out)
+            if ready:
+                logging.info('=== PYTHON DRIVER VERSION {}, PROTOCOL v{} ==='.format(version, protocol))
+                await loop.run_in_executor(executor, result.execute)
+            return result
+
+        return await asyncio.gather(*[run_protocol(version, protocol) for version in versions for protocol in protocols])
+
+
+def main(python_driver_git, scylla_install_dir, driver_type, tests, versions, protocols, scylla_version,
+         nose_processes=0, use_cache=True, cache_dir=None):
+    python_driver_git = os.path.abspath(python_driver_git)
+    cache_dir = os.path.abspath(cache_dir) if cache_dir else None
+    results = asyncio.run(_run_matrix(python_driver_git, scylla_install_dir, driver_type, tests, versions, protocols,
+                                      scylla_version, nose_processes, use_cache, cache_dir))
 
     logging.info('=== PYTHON DRIVER MATRIX RESULTS ===')
     status = 0
@@ -40,9 +77,16 @@ if __name__ == '__main__':
     parser.add_argument('--protocols', default=protocols,
                         help='cqlsh native protocol, default={}'.format(','.join(protocols)))
     parser.add_argument('--scylla-version', help="relocatable scylla version to use", default=os.environ.get('SCYLLA_VERSION', None))
+    parser.add_argument('--nose-processes', type=int, default=0, dest='nose_processes',
+                        help='number of processes nosetests spreads each protocol run over, default=0 (disabled)')
+    parser.add_argument('--no-cache', action='store_false', dest='use_cache',
+                        help='always run the tests, instead of reusing cached results of clean runs with the same '
+                             'driver commit, protocol, tests, patches, ignore list, relocatable scylla packages, '
+                             'event loop and scylla-ccm revision')
+    parser.add_argument('--cache-dir', dest='cache_dir', default=None,
+                        help='folder keeping the cached results, default=<temp dir>/.matrix-cache')
     arguments = parser.parse_args()
-    if not isinstance(arguments.versions, list):
-        versions = arguments.versions.split(',')
-    if not isinstance(arguments.protocols, list):
-        protocols = arguments.protocols.split(',')
-    main(arguments.python_driver_git, arguments.scylla_install_dir, arguments.driver_type, arguments.tests, versions, protocols, arguments.scylla_version)
+    versions = _as_list(arguments.versions)
+    protocols = _as_list(arguments.protocols, default=protocols)
+    main(arguments.python_driver_git, arguments.scylla_install_dir, arguments.driver_type, arguments.tests, versions, protocols, arguments.scylla_version,
+         arguments.nose_processes, arguments.use_cache, arguments.cache_dir)
@@ -7,11 +7,20 @@ import yaml
 class ProcessJUnit:
 
     def __init__(self, xunitFile, ignoreSet):
-        tree = xml.etree.ElementTree.parse(xunitFile)
+        self._summarize(xml.etree.ElementTree.parse(xunitFile), ignoreSet)
+
+    @classmethod
+    def from_etree(cls, tree, ignoreSet):
+        """Build the summary from an already parsed xunit tree, skipping another read of the file"""
+        junit = cls.__new__(cls)
+        junit._summarize(tree, ignoreSet)
+        return junit
+
+    def _summarize(self, tree, ignoreSet):
         self._ignore = ignoreSet
         logging.info('ignoring {}'.format(self._ignore))
         self._summary = {'testcase': 0, 'failure': 0, 'error': 0, 'skipped': 0, 'ignored_in_analysis': 0}
-        for element in tree.getiterator():
+        for element in tree.iter():
             if self._shouldIgnore(element):
                 self._summary['ignored_in_analysis'] += 1
                 continue
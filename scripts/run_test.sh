@@ -97,6 +97,7 @@ docker_cmd="docker run --detach=true \
     -v ${PYTHON_MATRIX_DIR}:${PYTHON_MATRIX_DIR} \
     -v ${PYTHON_DRIVER_DIR}:${PYTHON_DRIVER_DIR} \
     -v ${CCM_DIR}:${CCM_DIR} \
+    -e CCM_DIR \
     -e HOME \
     -e SCYLLA_EXT_OPTS \
     -e LC_ALL=en_US.UTF-8 \